@@ -1,43 +1,39 @@
-import json
 import re
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import Iterable, Iterator, Dict, Any, Optional
+import orjson
 import pandas as pd
 
 
+_BUYER_SPLIT_RE = re.compile(r'^[ \t]*Buyer:[ \t]*$', re.MULTILINE)
+_ATTACH_RE = re.compile(r'attachment:\s*(.+?)(?:\n|$)')
+_UUID_PREFIX_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}:')
+_SENDER_RE = re.compile(r'Von:\s*(.+?)\s+([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})')
+_ORDER_COMBINED = re.compile(
+    r'(?=(?:Bestellung\s+BT\s+(?P<bt>\d+))'
+    r'|(?:Hofbauer[_-](?P<hb>\d+))'
+    r'|(?:Bestellung\s+(?:Nr\.\s+)?(?P<bg>\S+))'
+    r'|(?:order[_\s]+number[:\s]+(?P<on>\S+)))',
+    re.IGNORECASE
+)
+_ORDER_GROUP_RANK = ('bt', 'hb', 'bg', 'on')
+
+
 def parse_expected_output_to_json(input_file: str, output_file: str) -> None:
     with open(input_file, 'r', encoding='utf-8') as f:
         content = f.read()
 
     records = []
-    current_record = {}
-    current_products = []
-
-    lines = content.strip().split('\n')
-
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-
-        if line == "Buyer:":
-            if current_record:
-                if current_products:
-                    current_record['products'] = current_products
-                records.append(current_record)
-                current_record = {}
-                current_products = []
-            i += 1
-            continue
-
-        if line == "Order:":
-            i += 1
-            continue
-
-        if line in ["Product:", "Products:"]:
-            i += 1
-            continue
-
-        if line.startswith('•'):
+
+    for chunk in _BUYER_SPLIT_RE.split(content.strip()):
+        record = {}
+        products = []
+
+        for line in chunk.splitlines():
+            line = line.strip()
+            if not line.startswith('•'):
+                continue
+
             field_line = line[1:].strip()
             if ':' in field_line:
                 key, value = field_line.split(':', 1)
@@ -45,61 +41,77 @@ def parse_expected_output_to_json(input_file: str, output_file: str) -> None:
                 value = value.strip()
 
                 if key == 'position':
-                    current_products.append({'position': int(value)})
+                    products.append({'position': int(value)})
                 elif key in ['article_code', 'quantity']:
-                    if current_products:
+                    if products:
                         if key == 'quantity':
-                            current_products[-1][key] = int(value)
+                            products[-1][key] = int(value)
                         else:
-                            current_products[-1][key] = value
+                            products[-1][key] = value
                 else:
-                    current_record[key] = value
+                    record[key] = value
 
-        i += 1
+        if record:
+            if products:
+                record['products'] = products
+            records.append(record)
 
-    if current_record:
-        if current_products:
-            current_record['products'] = current_products
-        records.append(current_record)
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(records, option=orjson.OPT_INDENT_2))
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(records, f, indent=2, ensure_ascii=False)
 
+def _find_order_number(email_block: str) -> Optional[str]:
+    best_rank = len(_ORDER_GROUP_RANK)
+    order_number = None
 
-def parse_emails_and_match(emails_file: str, expected_output_file: str) -> List[Dict[str, Any]]:
-    with open(expected_output_file, 'r', encoding='utf-8') as f:
-        expected_outputs = json.load(f)
+    for order_match in _ORDER_COMBINED.finditer(email_block):
+        rank = _ORDER_GROUP_RANK.index(order_match.lastgroup)
+        if rank < best_rank:
+            best_rank = rank
+            order_number = order_match.group(order_match.lastgroup)
+            if rank == 0:
+                break
 
-    order_lookup = {record['order_number']: record for record in expected_outputs}
+    return order_number
 
-    with open(emails_file, 'r', encoding='utf-8') as f:
-        emails_content = f.read()
 
-    email_blocks = []
-    current_email = []
+def iter_email_blocks(emails_file: str) -> Iterator[str]:
+    with open(emails_file, 'r', encoding='utf-8') as f:
+        current_email = []
+        line = ''
 
-    for line in emails_content.split('\n'):
-        if line.startswith('attachment:'):
-            if current_email:
-                email_blocks.append('\n'.join(current_email))
+        for line in f:
+            stripped_line = line.rstrip('\n')
+            if stripped_line.startswith('attachment:') and current_email:
+                yield '\n'.join(current_email)
                 current_email = []
-            current_email.append(line)
-        else:
-            current_email.append(line)
+            current_email.append(stripped_line)
+
+        if line.endswith('\n'):
+            current_email.append('')
 
     if current_email:
-        email_blocks.append('\n'.join(current_email))
+        yield '\n'.join(current_email)
+
 
-    matched_data = []
+def parse_emails_and_match(emails_file: str, expected_output_file: str) -> Iterator[Dict[str, Any]]:
+    with open(expected_output_file, 'rb') as f:
+        expected_outputs = orjson.loads(f.read())
+
+    order_lookup = {record['order_number']: record for record in expected_outputs}
 
-    for email_block in email_blocks:
-        attachment_match = re.search(r'attachment:\s*(.+?)(?:\n|$)', email_block)
+    for email_block in iter_email_blocks(emails_file):
+        attachment_match = _ATTACH_RE.search(email_block)
         attachment_filename = attachment_match.group(1).strip() if attachment_match else None
 
         if attachment_filename:
-            attachment_filename = re.sub(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}:', '', attachment_filename)
+            attachment_filename = _UUID_PREFIX_RE.sub('', attachment_filename)
 
-        email_content_clean = re.sub(r'^attachment:.*?\n', '', email_block, flags=re.MULTILINE).strip()
+        first_newline = email_block.find('\n')
+        if email_block.startswith('attachment:') and first_newline != -1:
+            email_content_clean = email_block[first_newline + 1:].strip()
+        else:
+            email_content_clean = email_block.strip()
 
         email_data = {
             'email_content': email_content_clean,
@@ -110,44 +122,38 @@ def parse_emails_and_match(emails_file: str, expected_output_file: str) -> List[
             'expected_output': None
         }
 
-        sender_match = re.search(r'Von:\s*(.+?)\s+([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})', email_block)
+        sender_match = _SENDER_RE.search(email_block)
         if sender_match:
             email_data['sender_name'] = sender_match.group(1).strip()
             email_data['sender_email'] = sender_match.group(2).strip()
 
-        order_patterns = [
-            r'Bestellung\s+BT\s+(\d+)',
-            r'Hofbauer[_-](\d+)',
-            r'Bestellung\s+(?:Nr\.\s+)?(\S+)',
-            r'order[_\s]+number[:\s]+(\S+)',
-        ]
-
-        for pattern in order_patterns:
-            order_match = re.search(pattern, email_block, re.IGNORECASE)
-            if order_match:
-                email_data['order_number'] = order_match.group(1).strip()
-                break
+        email_data['order_number'] = _find_order_number(email_block)
 
         if email_data['order_number'] and email_data['order_number'] in order_lookup:
             email_data['expected_output'] = order_lookup[email_data['order_number']]
 
-        matched_data.append(email_data)
+        yield email_data
 
-    return matched_data
 
+def create_dataframe_and_save(matched_data: Iterable[Dict[str, Any]], output_file: str, csv_file: str = None) -> None:
+    filenames = []
+    emails = []
+    expected_outputs = []
 
-def create_dataframe_and_save(matched_data: List[Dict[str, Any]], output_file: str) -> None:
-    rows = []
     for item in matched_data:
-        row = {
-            'filename': item['attachment'],
-            'email': item['email_content'],
-            'expected_output': json.dumps(item['expected_output'], ensure_ascii=False) if item['expected_output'] else None
-        }
-        rows.append(row)
+        filenames.append(item['attachment'])
+        emails.append(item['email_content'])
+        expected_outputs.append(orjson.dumps(item['expected_output']).decode() if item['expected_output'] else None)
+
+    df = pd.DataFrame({
+        'filename': filenames,
+        'email': emails,
+        'expected_output': expected_outputs
+    })
+    df.to_feather(output_file)
 
-    df = pd.DataFrame(rows)
-    df.to_csv(output_file, index=False, encoding='utf-8')
+    if csv_file:
+        df.to_csv(csv_file, index=False, encoding='utf-8')
 
 
 if __name__ == "__main__":
@@ -155,8 +161,8 @@ if __name__ == "__main__":
     input_file = base_dir / "data" / "expected_output.txt"
     output_json = base_dir / "data" / "expected_output.json"
     emails_file = base_dir / "data" / "emails.txt"
-    matched_csv = base_dir / "data" / "matched_emails_output.csv"
+    matched_feather = base_dir / "data" / "matched_emails_output.feather"
 
     parse_expected_output_to_json(str(input_file), str(output_json))
     matched_data = parse_emails_and_match(str(emails_file), str(output_json))
-    create_dataframe_and_save(matched_data, str(matched_csv))
+    create_dataframe_and_save(matched_data, str(matched_feather))
@@ -1,61 +1,69 @@
 import os
-import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+import orjson
 import pandas as pd
 from dotenv import load_dotenv
 from langfuse import Langfuse
 
 
-def init_langfuse() -> Langfuse:
-    load_dotenv()
+load_dotenv()
 
-    secret_key = os.getenv('LANGFUSE_SECRET_KEY')
-    public_key = os.getenv('LANGFUSE_PUBLIC_KEY')
-    base_url = os.getenv('LANGFUSE_BASE_URL')
+_LANGFUSE_SECRET_KEY = (os.getenv('LANGFUSE_SECRET_KEY') or '').strip('"')
+_LANGFUSE_PUBLIC_KEY = (os.getenv('LANGFUSE_PUBLIC_KEY') or '').strip('"')
+_LANGFUSE_BASE_URL = (os.getenv('LANGFUSE_BASE_URL') or '').strip('"')
 
-    if not all([secret_key, public_key, base_url]):
-        raise ValueError("Langfuse credentials not found in .env file")
 
-    secret_key = secret_key.strip('"')
-    public_key = public_key.strip('"')
-    base_url = base_url.strip('"')
+@lru_cache(maxsize=None)
+def init_langfuse() -> Langfuse:
+    if not all([_LANGFUSE_SECRET_KEY, _LANGFUSE_PUBLIC_KEY, _LANGFUSE_BASE_URL]):
+        raise ValueError("Langfuse credentials not found in .env file")
 
     client = Langfuse(
-        secret_key=secret_key,
-        public_key=public_key,
-        host=base_url
+        secret_key=_LANGFUSE_SECRET_KEY,
+        public_key=_LANGFUSE_PUBLIC_KEY,
+        host=_LANGFUSE_BASE_URL
     )
 
     return client
 
 
-def create_langfuse_dataset(csv_path: str, dataset_name: str = "email_order_extraction") -> None:
+def create_langfuse_dataset(data_path: str, dataset_name: str = "email_order_extraction", max_workers: int = 16) -> None:
     client = init_langfuse()
 
-    df = pd.read_csv(csv_path)
+    records = pd.read_feather(data_path).to_dict(orient='records')
 
-    client.create_dataset(name=dataset_name)
-
-    for idx, row in df.iterrows():
-        expected_output = json.loads(row['expected_output']) if pd.notna(row['expected_output']) else None
+    items = [
+        (
+            {
+                "filename": row['filename'],
+                "email": row['email']
+            },
+            orjson.loads(row['expected_output']) if pd.notna(row['expected_output']) else None
+        )
+        for row in records
+    ]
 
-        input_data = {
-            "filename": row['filename'],
-            "email": row['email']
-        }
+    client.create_dataset(name=dataset_name)
 
-        client.create_dataset_item(
+    def create_item(item):
+        input_data, expected_output = item
+        return client.create_dataset_item(
             dataset_name=dataset_name,
             input=input_data,
             expected_output=expected_output
         )
 
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(create_item, items))
+
 
 if __name__ == "__main__":
     base_dir = Path(__file__).parent.parent
-    csv_file = base_dir / "data" / "matched_emails_output.csv"
+    data_file = base_dir / "data" / "matched_emails_output.feather"
 
     create_langfuse_dataset(
-        csv_path=str(csv_file),
+        data_path=str(data_file),
         dataset_name="email_order_extraction"
     )
@@ -1,23 +1,48 @@
-import json
-import base64
+import asyncio
+import contextvars
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import List
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 import fitz
+import orjson
 from pydantic import BaseModel, Field
-from langfuse import Langfuse
 from jinja2 import Environment, FileSystemLoader
+from src.langfuse_integration import init_langfuse
 
 try:
     from langfuse.client import Evaluation
 except ImportError:
     from langfuse import Evaluation
 
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+
+load_dotenv()
 
 MODEL_NAME = "gpt-4o"
+MAX_CONCURRENCY = 8
+USE_PDF_TEXT = False
+PDF_TEXT_MIN_CHARS = 200
+
+_AZURE_OPENAI_KEY = os.getenv('AZURE_OPENAI_KEY')
+_AZURE_OPENAI_ENDPOINT = os.getenv('AZURE_OPENAI_RESOURCE_URL')
+
+_BUYER_FIELDS = ('buyer_company_name', 'buyer_person_name', 'buyer_email_address')
+_ORDER_FIELDS = ('order_number', 'order_date')
+_ADDRESS_FIELDS = ('delivery_address_street', 'delivery_address_city', 'delivery_address_postal_code')
+_ALL_FIELDS = _BUYER_FIELDS + _ORDER_FIELDS + _ADDRESS_FIELDS + ('products',)
+
+_PDF_RENDER_LOCK = threading.Lock()
+_JSON_FENCE_RE = re.compile(r'```json\s*(.*?)\s*```', re.DOTALL)
 
 
 class Product(BaseModel):
@@ -42,19 +67,29 @@ class OrderExtraction(BaseModel):
     products: List[Product] = Field(description="List of products in the order")
 
 
+def _canonical_product(product: dict) -> tuple:
+    return (product.get('position'), product.get('article_code'), product.get('quantity'))
+
+
+def _render_page(page) -> str:
+    pix = page.get_pixmap(matrix=fitz.Matrix(1.5, 1.5))
+    img_bytes = pix.tobytes("jpeg", jpg_quality=85)
+    return base64.b64encode(img_bytes).decode('ascii')
+
+
 def convert_pdf_to_images(pdf_path: str) -> List[str]:
-    pdf_document = fitz.open(pdf_path)
-    base64_images = []
+    with _PDF_RENDER_LOCK:
+        with fitz.open(pdf_path) as pdf_document:
+            return [_render_page(page) for page in pdf_document]
+
 
-    for page_num in range(len(pdf_document)):
-        page = pdf_document[page_num]
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-        img_bytes = pix.tobytes("png")
-        img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-        base64_images.append(img_base64)
+def extract_pdf_text(pdf_path: str) -> str:
+    with _PDF_RENDER_LOCK:
+        with fitz.open(pdf_path) as pdf_document:
+            texts = [page.get_text("text") for page in pdf_document]
 
-    pdf_document.close()
-    return base64_images
+    pdf_text = "\n\n".join(texts)
+    return pdf_text if len(pdf_text.strip()) >= PDF_TEXT_MIN_CHARS else ""
 
 
 def create_extraction_prompt() -> str:
@@ -64,53 +99,78 @@ def create_extraction_prompt() -> str:
     return template.render()
 
 
-def call_azure_openai_with_vision(email_text: str, pdf_path: str, expected_output: dict = None) -> dict:
-    load_dotenv()
+def add_additional_properties_false(obj):
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, dict):
+            if current.get("type") == "object":
+                current["additionalProperties"] = False
+            stack.extend(current.values())
+        elif isinstance(current, list):
+            stack.extend(current)
+
+
+_SYSTEM_PROMPT = create_extraction_prompt()
 
-    api_key = os.getenv('AZURE_OPENAI_KEY')
-    endpoint = os.getenv('AZURE_OPENAI_RESOURCE_URL')
+_ORDER_SCHEMA = OrderExtraction.model_json_schema()
+add_additional_properties_false(_ORDER_SCHEMA)
 
-    if not api_key or not endpoint:
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "order_extraction_schema",
+        "schema": _ORDER_SCHEMA,
+        "strict": True
+    }
+}
+
+
+@lru_cache(maxsize=None)
+def _get_azure_client() -> AzureOpenAI:
+    if not _AZURE_OPENAI_KEY or not _AZURE_OPENAI_ENDPOINT:
         raise ValueError("Azure OpenAI credentials not found in .env file")
 
-    client = AzureOpenAI(
-        api_key=api_key,
+    return AzureOpenAI(
+        api_key=_AZURE_OPENAI_KEY,
         api_version="2024-08-01-preview",
-        azure_endpoint=endpoint
+        azure_endpoint=_AZURE_OPENAI_ENDPOINT
     )
 
-    pdf_images = convert_pdf_to_images(pdf_path)
-    system_prompt = create_extraction_prompt()
-
-    user_content = [
-        {
-            "type": "text",
-            "text": f"**EMAIL:**\n\n{email_text}\n\n**Extract the order information from the email above and the PDF images below:**"
-        }
-    ]
-
-    for i, img_base64 in enumerate(pdf_images):
-        user_content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/png;base64,{img_base64}",
-                "detail": "high"
-            }
-        })
 
-    schema = OrderExtraction.model_json_schema()
+def call_azure_openai_with_vision(email_text: str, pdf_path: str, expected_output: dict = None) -> dict:
+    client = _get_azure_client()
+
+    pdf_text = extract_pdf_text(pdf_path) if USE_PDF_TEXT else ""
+    system_prompt = _SYSTEM_PROMPT
 
-    def add_additional_properties_false(obj):
-        if isinstance(obj, dict):
-            if obj.get("type") == "object":
-                obj["additionalProperties"] = False
-            for value in obj.values():
-                add_additional_properties_false(value)
-        elif isinstance(obj, list):
-            for item in obj:
-                add_additional_properties_false(item)
+    if pdf_text:
+        user_content = [
+            {
+                "type": "text",
+                "text": f"**EMAIL:**\n\n{email_text}\n\n**Extract the order information from the email above and the PDF text below:**"
+            },
+            {
+                "type": "text",
+                "text": f"**PDF:**\n\n{pdf_text}"
+            }
+        ]
+    else:
+        user_content = [
+            {
+                "type": "text",
+                "text": f"**EMAIL:**\n\n{email_text}\n\n**Extract the order information from the email above and the PDF images below:**"
+            }
+        ]
 
-    add_additional_properties_false(schema)
+        for img_base64 in convert_pdf_to_images(pdf_path):
+            user_content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{img_base64}",
+                    "detail": "high"
+                }
+            })
 
     api_params = {
         "model": MODEL_NAME,
@@ -125,14 +185,7 @@ def call_azure_openai_with_vision(email_text: str, pdf_path: str, expected_outpu
             }
         ],
         "max_completion_tokens": 3000,
-        "response_format": {
-            "type": "json_schema",
-            "json_schema": {
-                "name": "order_extraction_schema",
-                "schema": schema,
-                "strict": True
-            }
-        }
+        "response_format": _RESPONSE_FORMAT
     }
 
     response = client.chat.completions.create(**api_params)
@@ -142,15 +195,16 @@ def call_azure_openai_with_vision(email_text: str, pdf_path: str, expected_outpu
         if not extracted_text or extracted_text.strip() == "":
             raise ValueError("Empty response from API")
 
-        json_match = re.search(r'```json\s*(.*?)\s*```', extracted_text, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(1)
+        stripped_text = extracted_text.lstrip()
+        if stripped_text.startswith('{'):
+            json_str = stripped_text
         else:
-            json_str = extracted_text
+            json_match = _JSON_FENCE_RE.search(extracted_text)
+            json_str = json_match.group(1) if json_match else extracted_text
 
-        extracted_data = json.loads(json_str)
+        extracted_data = orjson.loads(json_str)
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         raise ValueError(f"JSON parsing failed: {extracted_text[:500] if extracted_text else 'EMPTY'}")
     except Exception as e:
         raise ValueError(f"Schema validation failed: {str(e)}")
@@ -167,15 +221,10 @@ def call_azure_openai_with_vision(email_text: str, pdf_path: str, expected_outpu
 
 
 def run_langfuse_experiment(dataset_name: str = "email_order_extraction", pdfs_dir: str = None):
-    load_dotenv()
-
-    client = Langfuse(
-        secret_key=os.getenv('LANGFUSE_SECRET_KEY').strip('"'),
-        public_key=os.getenv('LANGFUSE_PUBLIC_KEY').strip('"'),
-        host=os.getenv('LANGFUSE_BASE_URL').strip('"')
-    )
+    client = init_langfuse()
 
     dataset = client.get_dataset(name=dataset_name)
+    task_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
 
     def extraction_task(item):
         filename = item.input['filename']
@@ -195,18 +244,15 @@ def run_langfuse_experiment(dataset_name: str = "email_order_extraction", pdfs_d
 
         return result['extracted_data']
 
-    def exact_match_evaluator(output, expected_output, **kwargs):
-        fields_to_compare = [
-            'buyer_company_name', 'buyer_person_name', 'buyer_email_address',
-            'order_number', 'order_date',
-            'delivery_address_street', 'delivery_address_city', 'delivery_address_postal_code',
-            'products'
-        ]
+    async def concurrent_extraction_task(*, item, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(task_executor, contextvars.copy_context().run, extraction_task, item)
 
+    def exact_match_evaluator(output, expected_output, **kwargs):
         if expected_output is None or output is None:
             score = 0
         else:
-            score = 1 if all(expected_output.get(f) == output.get(f) for f in fields_to_compare) else 0
+            score = 1 if all(expected_output.get(f) == output.get(f) for f in _ALL_FIELDS) else 0
 
         return Evaluation(
             name="exact_match",
@@ -218,42 +264,39 @@ def run_langfuse_experiment(dataset_name: str = "email_order_extraction", pdfs_d
         if not output or not expected_output:
             return Evaluation(name="buyer_info", value=0.0, comment="Missing output or expected output")
 
-        buyer_fields = ['buyer_company_name', 'buyer_person_name', 'buyer_email_address']
-        matches = sum(1 for f in buyer_fields if output.get(f) == expected_output.get(f))
-        score = matches / len(buyer_fields)
+        matches = sum(1 for f in _BUYER_FIELDS if output.get(f) == expected_output.get(f))
+        score = matches / len(_BUYER_FIELDS)
 
         return Evaluation(
             name="buyer_info",
             value=score,
-            comment=f"{matches}/{len(buyer_fields)} buyer fields match"
+            comment=f"{matches}/{len(_BUYER_FIELDS)} buyer fields match"
         )
 
     def order_info_evaluator(output, expected_output, **kwargs):
         if not output or not expected_output:
             return Evaluation(name="order_info", value=0.0, comment="Missing output or expected output")
 
-        order_fields = ['order_number', 'order_date']
-        matches = sum(1 for f in order_fields if output.get(f) == expected_output.get(f))
-        score = matches / len(order_fields)
+        matches = sum(1 for f in _ORDER_FIELDS if output.get(f) == expected_output.get(f))
+        score = matches / len(_ORDER_FIELDS)
 
         return Evaluation(
             name="order_info",
             value=score,
-            comment=f"{matches}/{len(order_fields)} order fields match"
+            comment=f"{matches}/{len(_ORDER_FIELDS)} order fields match"
         )
 
     def address_info_evaluator(output, expected_output, **kwargs):
         if not output or not expected_output:
             return Evaluation(name="address_info", value=0.0, comment="Missing output or expected output")
 
-        address_fields = ['delivery_address_street', 'delivery_address_city', 'delivery_address_postal_code']
-        matches = sum(1 for f in address_fields if output.get(f) == expected_output.get(f))
-        score = matches / len(address_fields)
+        matches = sum(1 for f in _ADDRESS_FIELDS if output.get(f) == expected_output.get(f))
+        score = matches / len(_ADDRESS_FIELDS)
 
         return Evaluation(
             name="address_info",
             value=score,
-            comment=f"{matches}/{len(address_fields)} address fields match"
+            comment=f"{matches}/{len(_ADDRESS_FIELDS)} address fields match"
         )
 
     def products_evaluator(output, expected_output, **kwargs):
@@ -263,7 +306,10 @@ def run_langfuse_experiment(dataset_name: str = "email_order_extraction", pdfs_d
         output_products = output.get('products', [])
         expected_products = expected_output.get('products', [])
 
-        score = 1.0 if output_products == expected_products else 0.0
+        score = 1.0 if (
+            len(output_products) == len(expected_products)
+            and [_canonical_product(p) for p in output_products] == [_canonical_product(p) for p in expected_products]
+        ) else 0.0
 
         return Evaluation(
             name="products",
@@ -294,25 +340,28 @@ def run_langfuse_experiment(dataset_name: str = "email_order_extraction", pdfs_d
             comment=f"Average score across all evaluators: {avg:.2%} ({len(scores)} total evaluations)"
         )
 
-    dataset.run_experiment(
-        name=f"{MODEL_NAME} Order Extraction",
-        description="Extract order information from emails and PDF attachments",
-        task=extraction_task,
-        evaluators=[
-            exact_match_evaluator,
-            buyer_info_evaluator,
-            order_info_evaluator,
-            address_info_evaluator,
-            products_evaluator
-        ],
-        run_evaluators=[
-            average_score
-        ],
-        metadata={
-            'model': MODEL_NAME,
-            'approach': 'Extraction with strict JSON schema and Pydantic validation'
-        }
-    )
+    with task_executor:
+        dataset.run_experiment(
+            name=f"{MODEL_NAME} Order Extraction",
+            description="Extract order information from emails and PDF attachments",
+            task=concurrent_extraction_task,
+            evaluators=[
+                exact_match_evaluator,
+                buyer_info_evaluator,
+                order_info_evaluator,
+                address_info_evaluator,
+                products_evaluator
+            ],
+            run_evaluators=[
+                average_score
+            ],
+            max_concurrency=MAX_CONCURRENCY,
+            metadata={
+                'model': MODEL_NAME,
+                'pdf_input': 'text' if USE_PDF_TEXT else 'images',
+                'approach': 'Extraction with strict JSON schema and Pydantic validation'
+            }
+        )
 
     client.flush()
 